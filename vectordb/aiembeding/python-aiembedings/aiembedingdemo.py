@@ -7,25 +7,23 @@ Supports get-embeddings, store-embeddings, and query-similar commands.
 """
 
 import argparse
+import contextlib
+import csv
+import importlib
+import importlib.util
 import json
 import os
 import sys
+import time
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Tuple, Dict, Any, List
+from typing import TYPE_CHECKING, Optional, Tuple, Dict, Any, List, Iterable, TextIO, Union
 
-# Third-party imports
-try:
+# Third-party packages are imported lazily, on first use (see require()),
+# so each subcommand only pays for the dependencies it actually needs.
+if TYPE_CHECKING:
+    import numpy as np
     import psycopg2
-    from psycopg2.extras import Json
-    from dotenv import load_dotenv
-    from openai import OpenAI
-    from pypdf import PdfReader
-except ImportError as e:
-    print(f"Error: Missing required package. Please install dependencies:")
-    print("  uv pip install -r requirements.txt")
-    print(f"\nMissing package: {e.name}")
-    sys.exit(1)
 
 # Constants
 MODEL = "text-embedding-3-small"
@@ -33,6 +31,8 @@ EMBEDDING_DIMENSIONS = 1536
 MAX_TOKENS = 8192  # OpenAI model token limit
 CHUNK_SIZE = 5000  # Conservative chunk size in tokens (leave room for safety)
 CHARS_PER_TOKEN = 2  # Conservative approximation for math/special chars (1 token ≈ 2-4 chars)
+BATCH_MAX_INPUTS = 2048  # OpenAI limit: inputs per embeddings request
+BATCH_MAX_TOKENS = 300000  # OpenAI limit: total tokens per embeddings request
 DB_CONFIG = {
     "host": "localhost",
     "port": 5432,
@@ -41,6 +41,74 @@ DB_CONFIG = {
     "database": "vectordb"
 }
 RESULT_LIMIT = 5
+STREAM_BATCH_SIZE = 1000  # Rows per FETCH from the server-side cursor (--stream)
+EXACT_SCAN_MIN_K = 100  # From this limit + offset on, ivfflat index scans probe all lists
+
+# Selectable query-similar output columns (name -> SQL expression)
+QUERY_COLUMNS = {
+    "id": "id",
+    "text": "text",
+    "text_preview": "LEFT(text, 100)",
+    "source": "source",
+    "metadata": "metadata",
+    "similarity": "1 - (embedding <=> %(vector)s::vector)",
+    "distance": "embedding <=> %(vector)s::vector",
+    "created_at": "created_at",
+}
+DEFAULT_COLUMNS = "id,source,similarity,distance,text_preview"
+TABLE_COLUMNS = ("id", "text_preview", "source", "similarity", "distance")
+
+# Document mode (query-similar --documents)
+DOCUMENT_AGGREGATES = {
+    "max": "MAX(similarity)",
+    "mean": "AVG(similarity)",
+    "sum-top": "SUM(similarity) FILTER (WHERE rank <= %(top_m)s)",
+}
+DOCUMENT_COLUMNS = ("source", "score", "best_similarity", "matched_chunks")
+PER_CHUNK_LIMIT = 20  # Nearest stored chunks fetched for each query chunk
+TOP_M = 3  # Chunks summed per source with --aggregate sum-top
+
+# MMR diversity reranking (query-similar --mmr)
+MMR_LAMBDA = 0.5  # 1.0 = relevance only, 0.0 = diversity only
+MMR_CANDIDATES = 100  # Candidates fetched from the database for reranking
+
+
+def require(module: str, package: str, feature: str) -> Any:
+    """
+    Import a third-party module on first use.
+
+    Args:
+        module: Module to import, e.g. "psycopg2.extras"
+        package: Package that provides it (as listed in requirements.txt)
+        feature: Feature that needs it, used in the error message
+
+    Returns:
+        The imported module
+    """
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        missing_dependency(package, feature)
+
+
+def check_installed(module: str, package: str, feature: str) -> None:
+    """
+    Fail early if a third-party module is missing, without importing it.
+
+    Args:
+        module: Top-level module name, e.g. "psycopg2"
+        package: Package that provides it (as listed in requirements.txt)
+        feature: Feature that needs it, used in the error message
+    """
+    if importlib.util.find_spec(module) is None:
+        missing_dependency(package, feature)
+
+
+def missing_dependency(package: str, feature: str) -> None:
+    """Report a missing third-party package and exit."""
+    print(f"Error: {feature} requires the '{package}' package. Please install dependencies:")
+    print("  uv pip install -r requirements.txt")
+    sys.exit(1)
 
 
 def load_env() -> None:
@@ -51,7 +119,8 @@ def load_env() -> None:
         env_path = Path(__file__).parent.parent / ".env"
 
     if env_path.exists():
-        load_dotenv(env_path)
+        dotenv = require("dotenv", "python-dotenv", "Loading .env files")
+        dotenv.load_dotenv(env_path)
 
 
 def get_api_key() -> str:
@@ -98,8 +167,9 @@ def read_text_input(text: Optional[str], text_file: Optional[str],
             print(f"Error: PDF file not found: {pdf_file}")
             sys.exit(1)
 
+        pypdf = require("pypdf", "pypdf", "--pdf-file")
         try:
-            reader = PdfReader(str(file_path))
+            reader = pypdf.PdfReader(str(file_path))
             text_content = ""
             for page in reader.pages:
                 text_content += page.extract_text()
@@ -118,19 +188,20 @@ def read_text_input(text: Optional[str], text_file: Optional[str],
         sys.exit(1)
 
 
-def get_embedding_from_openai(text: str, api_key: str) -> Dict[str, Any]:
+def get_embedding_from_openai(text: Union[str, List[str]], api_key: str) -> Dict[str, Any]:
     """
     Get embedding vector from OpenAI API.
 
     Args:
-        text: Text to embed
+        text: Text to embed, or a list of texts to embed in one batched request
         api_key: OpenAI API key
 
     Returns:
         API response dictionary
     """
+    openai = require("openai", "openai", "OpenAI embeddings")
     try:
-        client = OpenAI(api_key=api_key)
+        client = openai.OpenAI(api_key=api_key)
         response = client.embeddings.create(
             model=MODEL,
             input=text
@@ -141,13 +212,50 @@ def get_embedding_from_openai(text: str, api_key: str) -> Dict[str, Any]:
         sys.exit(1)
 
 
-def connect_db() -> psycopg2.extensions.connection:
+def get_embeddings_batched(texts: List[str], api_key: str) -> List[List[float]]:
+    """
+    Get embedding vectors for many texts with as few OpenAI requests as possible.
+
+    All texts go into one request unless that would exceed the per-request
+    input count or token limits, in which case they are split into
+    consecutive batches.
+
+    Args:
+        texts: Texts to embed
+        api_key: OpenAI API key
+
+    Returns:
+        Embedding vectors, in the same order as texts
+    """
+    batches: List[List[str]] = [[]]
+    batch_tokens = 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if batches[-1] and (len(batches[-1]) >= BATCH_MAX_INPUTS
+                            or batch_tokens + tokens > BATCH_MAX_TOKENS):
+            batches.append([])
+            batch_tokens = 0
+        batches[-1].append(text)
+        batch_tokens += tokens
+
+    embeddings = []
+    for batch_idx, batch in enumerate(batches, start=1):
+        if len(batches) > 1:
+            print(f"  Request {batch_idx}/{len(batches)} ({len(batch)} chunk(s))...")
+        response = get_embedding_from_openai(batch, api_key)
+        embeddings.extend(item['embedding']
+                          for item in sorted(response['data'], key=lambda d: d['index']))
+    return embeddings
+
+
+def connect_db() -> "psycopg2.extensions.connection":
     """
     Connect to PostgreSQL database.
 
     Returns:
         Database connection
     """
+    psycopg2 = require("psycopg2", "psycopg2-binary", "Database access")
     try:
         conn = psycopg2.connect(**DB_CONFIG)
         return conn
@@ -259,6 +367,9 @@ def chunk_text(text: str, chunk_size_tokens: int = CHUNK_SIZE) -> List[str]:
 # Command: get-embeddings
 def cmd_get_embeddings(args: argparse.Namespace) -> None:
     """Get embeddings command handler."""
+    # Fail before any output if a needed package is missing
+    check_installed("openai", "openai", "OpenAI embeddings")
+
     load_env()
     api_key = get_api_key()
 
@@ -297,6 +408,11 @@ def cmd_get_embeddings(args: argparse.Namespace) -> None:
 # Command: store-embeddings
 def cmd_store_embeddings(args: argparse.Namespace) -> None:
     """Store embeddings command handler with automatic chunking for large texts."""
+    # Fail before anything touches the database: --replace-if-exists deletes
+    # existing rows before the new embeddings are requested
+    check_installed("openai", "openai", "OpenAI embeddings")
+    check_installed("psycopg2", "psycopg2-binary", "Database access")
+
     load_env()
     api_key = get_api_key()
 
@@ -418,6 +534,7 @@ def cmd_store_embeddings(args: argparse.Namespace) -> None:
         metadata_base["size_bytes"] = file_path.stat().st_size
 
     # Store each chunk
+    extras = require("psycopg2.extras", "psycopg2-binary", "Database access")
     conn = connect_db()
     try:
         for chunk_idx, chunk in enumerate(chunks, start=1):
@@ -453,7 +570,7 @@ def cmd_store_embeddings(args: argparse.Namespace) -> None:
                     VALUES (%s, %s, %s::vector, %s)
                     RETURNING id, text, source, metadata, created_at
                     """,
-                    (text_to_store, source_name, json.dumps(embedding), Json(metadata))
+                    (text_to_store, source_name, json.dumps(embedding), extras.Json(metadata))
                 )
                 result = cur.fetchone()
                 conn.commit()
@@ -479,166 +596,753 @@ def cmd_store_embeddings(args: argparse.Namespace) -> None:
 
 
 # Command: query-similar
-def cmd_query_similar(args: argparse.Namespace) -> None:
-    """Query similar texts command handler."""
-    load_env()
-    api_key = get_api_key()
+def parse_columns(columns: str) -> List[str]:
+    """
+    Parse a comma-separated --columns value.
 
-    # Read input text
-    input_text, input_method, _ = read_text_input(args.text, args.text_file, args.pdf_file)
+    Args:
+        columns: Column names, e.g. "id,source,similarity"
 
-    print("=== Querying Similar Texts ===\n")
-    print(f"Input method: {input_method}")
-    print(f"Query text length: {len(input_text)} characters")
+    Returns:
+        List of validated column names
+    """
+    names = [name.strip() for name in columns.split(",") if name.strip()]
+    unknown = [name for name in names if name not in QUERY_COLUMNS]
+    if not names or unknown:
+        print(f"Error: Invalid --columns value: {columns}")
+        print(f"Available columns: {', '.join(QUERY_COLUMNS)}")
+        sys.exit(1)
+    return names
 
-    # Check if text exceeds token limit and truncate if needed
-    estimated_tokens = estimate_tokens(input_text)
-    print(f"Estimated tokens: {estimated_tokens}")
 
-    if estimated_tokens > CHUNK_SIZE:
-        print(f"\n⚠️  Query text exceeds token limit ({estimated_tokens} tokens > {CHUNK_SIZE})")
-        print(f"Using first {CHUNK_SIZE} tokens (~{CHUNK_SIZE * CHARS_PER_TOKEN} characters) for query...")
-        # Truncate to fit within token limit
-        max_chars = CHUNK_SIZE * CHARS_PER_TOKEN
-        input_text = input_text[:max_chars]
-        print(f"Truncated to {len(input_text)} characters\n")
-
-    print(f"Result limit: Top {RESULT_LIMIT} most similar")
-    print()
+def vector_hash(vector: str) -> str:
+    """
+    Short fingerprint of a query vector, used to bind page tokens to it.
 
-    # Preview query text
-    text_preview = input_text[:100] + ("..." if len(input_text) > 100 else "")
-    print("Query text preview:")
-    print(text_preview)
+    Args:
+        vector: Query vector as passed to the database (JSON array string)
+
+    Returns:
+        First 16 hex digits of the SHA-256 of the vector
+    """
+    import hashlib  # Only needed for paging; kept off the startup path
+
+    return hashlib.sha256(vector.encode()).hexdigest()[:16]
+
+
+def make_page_token(distance: float, ids: List[int], vector: str) -> str:
+    """
+    Build a keyset "next page" token from the last returned rows.
+
+    The token encodes the distance of the last row and the IDs of all
+    returned rows at exactly that distance (usually one), so the next page
+    starts right after them. Distances are only comparable for the exact
+    same query vector, so the token also carries the vector's fingerprint.
+
+    Args:
+        distance: Cosine distance of the last row
+        ids: IDs of the returned rows at that distance
+        vector: Query vector (JSON array string)
+
+    Returns:
+        Token in the form "<distance>:<id>[,<id>...]:<vector hash>"
+    """
+    return f"{distance!r}:{','.join(map(str, ids))}:{vector_hash(vector)}"
+
+
+def parse_page_token(token: str) -> Tuple[float, List[int], str]:
+    """
+    Parse a keyset token produced by make_page_token().
+
+    Args:
+        token: Token in the form "<distance>:<id>[,<id>...]:<vector hash>"
+
+    Returns:
+        Tuple of (distance, ids, vector hash)
+    """
+    try:
+        distance, ids, fingerprint = token.split(":")
+        return float(distance), [int(id_) for id_ in ids.split(",")], fingerprint
+    except ValueError:
+        print(f"Error: Invalid page token: {token}")
+        sys.exit(1)
+
+
+def load_query_vector(path: str) -> Tuple[List[float], str]:
+    """
+    Load a query vector saved with query-similar --dump-vector.
+
+    Args:
+        path: Path to the JSON file
+
+    Returns:
+        Tuple of (embedding, input text preview)
+    """
+    try:
+        with open(path, 'r') as f:
+            vector_data = json.load(f)
+        embedding = vector_data["embedding"]
+    except FileNotFoundError:
+        print(f"Error: File not found: {path}")
+        sys.exit(1)
+    except (ValueError, KeyError, TypeError):
+        print(f"Error: Not a query vector file (expected --dump-vector output): {path}")
+        sys.exit(1)
+    return embedding, vector_data.get("input_text_preview", "")
+
+
+def build_similarity_query(columns: List[str], keyset: bool = False,
+                           with_vectors: bool = False) -> str:
+    """
+    Build the nearest-neighbour SQL for query-similar.
+
+    Only the requested columns are selected. Rows are ordered by distance
+    alone so that the ivfflat index can return them in order; the keyset
+    condition only filters on distance, which keeps that plan.
+
+    Args:
+        columns: Column names from QUERY_COLUMNS
+        keyset: Whether to add the "after (distance, ids)" condition
+        with_vectors: Whether to also select the embedding in pgvector's
+            binary format (last column), used by the MMR rerank stage
+
+    Returns:
+        SQL string with named parameters (vector, limit, offset and,
+        for keyset pagination, after_distance and after_ids)
+    """
+    select_list = ",\n    ".join(f"{QUERY_COLUMNS[name]} AS {name}" for name in columns)
+    if with_vectors:
+        select_list += ",\n    vector_send(embedding) AS vector"
+    where = ""
+    if keyset:
+        where = ("WHERE embedding <=> %(vector)s::vector >= %(after_distance)s\n"
+                 "  AND NOT (embedding <=> %(vector)s::vector = %(after_distance)s"
+                 " AND id = ANY(%(after_ids)s))\n")
+    return (
+        f"SELECT\n    {select_list}\n"
+        "FROM text_embeddings\n"
+        f"{where}"
+        "ORDER BY embedding <=> %(vector)s::vector\n"
+        "LIMIT %(limit)s OFFSET %(offset)s"
+    )
+
+
+def exact_scan_settings(cur) -> Dict[str, str]:
+    """
+    Settings that make ivfflat index scans exact for large-k and keyset queries.
+
+    With the default ivfflat.probes = 1 an index scan reads one list only,
+    so a large LIMIT (or a later page) silently returns too few rows. With
+    probes = lists the scan is exact. enable_seqscan = off keeps the
+    planner on the index-ordered scan, which streams rows in distance order
+    and keeps its sort within work_mem, instead of a sequential scan plus
+    a sort that holds the whole LIMIT. (pgvector 0.8 iterative scans only
+    offer relaxed ordering for ivfflat, which keyset pagination cannot use.)
+
+    Args:
+        cur: Database cursor
+
+    Returns:
+        Dictionary of setting -> value (empty if there is no ivfflat index)
+    """
+    cur.execute(
+        """
+        SELECT MAX(COALESCE(substring(opt FROM '^lists=([0-9]+)$')::int, 100))
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_am am ON am.oid = c.relam
+        LEFT JOIN LATERAL unnest(c.reloptions) AS opt ON true
+        WHERE i.indrelid = 'text_embeddings'::regclass AND am.amname = 'ivfflat'
+        """
+    )
+    lists = cur.fetchone()[0]
+    if not lists:
+        return {}
+    return {"ivfflat.probes": str(lists), "enable_seqscan": "off"}
+
+
+def dump_query(path: str, cur, sql: str, params: Dict[str, Any],
+               input_method: str, settings: Optional[Dict[str, str]] = None) -> None:
+    """
+    Save the query-similar SQL to a file (template and executable form).
+
+    Args:
+        path: Output file path
+        cur: Database cursor (used to render the executable SQL)
+        sql: SQL template with named parameters
+        params: Query parameters
+        input_method: Input method used for the query text
+        settings: Session settings the query runs with
+    """
+    settings_sql = "".join(f"SET {name} = {value};\n" for name, value in (settings or {}).items())
+    try:
+        if "vectors" in params:
+            vector = json.loads(params["vectors"][0])
+        else:
+            vector = json.loads(params["vector"])
+        vector_preview = str(vector[:10]) + " ..."
+        executable_query = cur.mogrify(sql, params).decode()
+
+        # Write file (overwrite mode 'w')
+        with open(path, 'w') as f:
+            # Header
+            f.write("-- Query-Similar SQL Dump\n")
+            f.write(f"-- Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+            f.write(f"-- Input method: {input_method}\n")
+            f.write(f"-- Vector dimensions: {len(vector)}\n")
+            f.write(f"-- Result limit: {params['limit']}\n\n")
+
+            # Section 1: Template with parameters
+            f.write("-- " + "=" * 60 + "\n")
+            f.write("-- SECTION 1: SQL Template (with parameter placeholders)\n")
+            f.write("-- " + "=" * 60 + "\n\n")
+            f.write(settings_sql + sql + ";\n\n")
+            f.write("-- Parameters:\n")
+            if "vectors" in params:
+                f.write(f"-- vectors: {len(params['vectors'])} query chunk embedding vectors "
+                        f"({len(vector)} dimensions each)\n")
+                f.write(f"-- First 10 dimensions of chunk 1: {vector_preview}\n")
+            else:
+                f.write(f"-- vector: Query embedding vector ({len(vector)} dimensions)\n")
+                f.write(f"-- First 10 dimensions: {vector_preview}\n")
+            for name, value in params.items():
+                if name not in ("vector", "vectors"):
+                    f.write(f"-- {name}: {value}\n")
+            f.write("\n")
+
+            # Section 2: Executable SQL
+            f.write("-- " + "=" * 60 + "\n")
+            f.write("-- SECTION 2: Executable SQL (ready to run in PostgreSQL)\n")
+            f.write("-- " + "=" * 60 + "\n\n")
+            f.write(settings_sql + executable_query + ";\n\n")
+            f.write(f"-- Note: Full vector(s) embedded above ({len(vector)} dimensions)\n")
+
+        print(f"✓ Query saved to {path}\n")
+    except Exception as e:
+        print(f"Warning: Could not save query to file: {e}\n")
+
+
+def dump_vector(path: str, vector_data: Dict[str, Any]) -> None:
+    """
+    Save query embedding vector(s) to a JSON file.
+
+    Args:
+        path: Output file path
+        vector_data: JSON-serialisable vector data
+    """
+    try:
+        with open(path, 'w') as f:
+            json.dump(vector_data, f, indent=2)
+        print(f"✓ Vector saved to {path}\n")
+    except Exception as e:
+        print(f"Warning: Could not save vector to file: {e}\n")
+
+
+def build_document_query(aggregate: str) -> str:
+    """
+    Build the document-level similarity SQL for query-similar --documents.
+
+    A single statement finds the nearest stored chunks for every query
+    chunk (LATERAL join over the unnested query vectors), keeps the best
+    similarity per stored chunk, and aggregates per source.
+
+    Args:
+        aggregate: Aggregation name from DOCUMENT_AGGREGATES
+
+    Returns:
+        SQL string with named parameters (vectors, per_chunk, limit, offset
+        and, for sum-top, top_m)
+    """
+    return (
+        "WITH query_chunks AS (\n"
+        "    SELECT vec::vector AS embedding\n"
+        "    FROM unnest(%(vectors)s::text[]) AS q(vec)\n"
+        "),\n"
+        "hits AS (\n"
+        "    SELECT n.id, n.source, MAX(1 - n.distance) AS similarity\n"
+        "    FROM query_chunks q\n"
+        "    CROSS JOIN LATERAL (\n"
+        "        SELECT id, source, embedding <=> q.embedding AS distance\n"
+        "        FROM text_embeddings\n"
+        "        ORDER BY embedding <=> q.embedding\n"
+        "        LIMIT %(per_chunk)s\n"
+        "    ) n\n"
+        "    GROUP BY n.id, n.source\n"
+        "),\n"
+        "ranked AS (\n"
+        "    SELECT source, similarity,\n"
+        "           row_number() OVER (PARTITION BY source ORDER BY similarity DESC) AS rank\n"
+        "    FROM hits\n"
+        ")\n"
+        "SELECT\n"
+        "    source,\n"
+        f"    {DOCUMENT_AGGREGATES[aggregate]} AS score,\n"
+        "    MAX(similarity) AS best_similarity,\n"
+        "    COUNT(*) AS matched_chunks\n"
+        "FROM ranked\n"
+        "GROUP BY source\n"
+        "ORDER BY score DESC, source\n"
+        "LIMIT %(limit)s OFFSET %(offset)s"
+    )
+
+
+def vectors_from_binary(buffers: List[bytes]) -> "np.ndarray":
+    """
+    Stack vectors fetched with vector_send() into one float32 matrix.
+
+    pgvector's binary format is a 2-byte dimension count, 2 unused bytes
+    and the values as big-endian float4, so all rows are decoded with a
+    single frombuffer() instead of going through Python floats.
+
+    Args:
+        buffers: vector_send() results, all of the same dimension
+
+    Returns:
+        Array of shape (len(buffers), dimensions)
+    """
+    np = require("numpy", "numpy", "--mmr")
+    if not buffers:
+        return np.zeros((0, 0), dtype=np.float32)
+    dimensions = (len(buffers[0]) - 4) // 4
+    # Each row is read as dimensions + 1 floats; the first one is the header
+    matrix = np.frombuffer(b"".join(buffers), dtype=">f4").reshape(len(buffers), dimensions + 1)
+    return matrix[:, 1:].astype(np.float32)
+
+
+def mmr_rerank(vectors: "np.ndarray", relevance: "np.ndarray", sources: List[str],
+               k: int, lambda_: float = MMR_LAMBDA,
+               max_per_source: Optional[int] = None) -> List[int]:
+    """
+    Rerank candidates with maximal marginal relevance (MMR).
+
+    Each step picks the candidate maximising
+    lambda * relevance - (1 - lambda) * max similarity to already picked ones.
+    The candidate x candidate similarity matrix is computed once; every step
+    is a handful of vectorised NumPy operations over all candidates.
+
+    Args:
+        vectors: Candidate embeddings, shape (n, dimensions)
+        relevance: Cosine similarity of each candidate to the query, shape (n,)
+        sources: Source of each candidate (None for a NULL source)
+        k: Number of candidates to select
+        lambda_: Relevance/diversity trade-off (0.0-1.0)
+        max_per_source: Maximum number of selected candidates per source
+
+    Returns:
+        Indices of the selected candidates, in rank order
+    """
+    np = require("numpy", "numpy", "--mmr")
+    n = len(vectors)
+    if n == 0:
+        return []
+
+    # Normalise rows so that dot products are cosine similarities
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit = vectors / np.where(norms == 0, 1, norms)
+    similarity = unit @ unit.T
+
+    # source is nullable; NULL sources share one placeholder group
+    _, source_codes = np.unique(["" if source is None else source for source in sources],
+                                return_inverse=True)
+    source_counts = np.zeros(source_codes.max() + 1, dtype=int)
+
+    available = np.ones(n, dtype=bool)
+    redundancy = np.zeros(n, dtype=similarity.dtype)
+    selected: List[int] = []
+
+    while len(selected) < k and available.any():
+        scores = lambda_ * relevance - (1 - lambda_) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+
+        selected.append(best)
+        available[best] = False
+        if len(selected) == 1:
+            redundancy = similarity[best].copy()
+        else:
+            np.maximum(redundancy, similarity[best], out=redundancy)
+
+        if max_per_source:
+            code = source_codes[best]
+            source_counts[code] += 1
+            if source_counts[code] >= max_per_source:
+                available &= source_codes != code
+
+    return selected
+
+
+def write_results(rows: Iterable[Tuple], sql_columns: List[str], columns: List[str],
+                  output_format: str, out: TextIO,
+                  flush_every: int = STREAM_BATCH_SIZE) -> Tuple[int, Optional[float], List[int]]:
+    """
+    Write query-similar rows as they arrive.
+
+    Args:
+        rows: Iterable of result tuples in sql_columns order
+        sql_columns: Columns selected by the query
+        columns: Columns to output (jsonl/csv)
+        output_format: "table", "jsonl" or "csv"
+        out: Output stream for result rows
+        flush_every: Flush the output stream after this many rows
+
+    Returns:
+        Tuple of (row_count, distance of the last row or None,
+        IDs of the returned rows at that distance)
+    """
+    count = 0
+    last_distance = None
+    last_ids: List[int] = []
+    csv_writer = None
+
+    for row in rows:
+        record = dict(zip(sql_columns, row))
+        if record["distance"] != last_distance:
+            last_distance, last_ids = record["distance"], []
+        last_ids.append(record["id"])
+
+        if output_format == "table":
+            if count == 0:
+                print("=== Search Results ===\n", file=out)
+                print(f"{'ID':<5} {'Text Preview':<50} {'Source':<20} {'Similarity':<12} {'Distance':<12}", file=out)
+                print("-" * 110, file=out)
+            text_preview = record["text_preview"]
+            source = record["source"] or ""
+            # Truncate text preview if too long
+            text_preview = (text_preview[:47] + "...") if len(text_preview) > 50 else text_preview
+            source = (source[:17] + "...") if len(source) > 20 else source
+            print(f"{record['id']:<5} {text_preview:<50} {source:<20} "
+                  f"{record['similarity']:>11.4f} {record['distance']:>11.4f}", file=out)
+        elif output_format == "jsonl":
+            out.write(json.dumps({name: record[name] for name in columns}, default=str) + "\n")
+        else:
+            if csv_writer is None:
+                csv_writer = csv.writer(out)
+                csv_writer.writerow(columns)
+            csv_writer.writerow([
+                json.dumps(record[name]) if name == "metadata" else record[name]
+                for name in columns
+            ])
+
+        count += 1
+        if count % flush_every == 0:
+            out.flush()
+
+    out.flush()
+    return count, last_distance, last_ids
+
+
+def cmd_query_similar(args: argparse.Namespace) -> None:
+    """Query similar texts command handler."""
+    # Result rows go to stdout; for machine-readable formats all progress
+    # messages are sent to stderr so stdout can be piped as-is.
+    out = sys.stdout
+    log = sys.stdout if args.format == "table" else sys.stderr
+    with contextlib.redirect_stdout(log):
+        query_similar(args, out)
+
+
+def query_similar(args: argparse.Namespace, out: TextIO) -> None:
+    """Run query-similar, writing result rows to out."""
+    if args.limit < 1 or args.offset < 0 or args.batch_size < 1:
+        print("Error: --limit and --batch-size must be >= 1, --offset must be >= 0")
+        sys.exit(1)
+    if args.documents and (args.stream or args.after or args.query_vector or args.columns or args.exact):
+        print("Error: --stream, --after, --query-vector, --columns and --exact are not supported with --documents")
+        sys.exit(1)
+    if args.per_chunk < 1 or args.top_m < 1:
+        print("Error: --per-chunk and --top-m must be >= 1")
+        sys.exit(1)
+    if args.mmr and (args.documents or args.stream or args.after or args.offset):
+        print("Error: --mmr cannot be combined with --documents, --stream, --after or --offset")
+        sys.exit(1)
+    if args.max_per_source is not None and not args.mmr:
+        print("Error: --max-per-source requires --mmr")
+        sys.exit(1)
+    if (not 0.0 <= args.mmr_lambda <= 1.0 or args.mmr_candidates < 1
+            or (args.max_per_source is not None and args.max_per_source < 1)):
+        print("Error: --mmr-lambda must be between 0 and 1, --mmr-candidates and --max-per-source must be >= 1")
+        sys.exit(1)
+
+    if args.format == "table":
+        columns = list(TABLE_COLUMNS)
+    else:
+        columns = parse_columns(args.columns or DEFAULT_COLUMNS)
+    after = parse_page_token(args.after) if args.after else None
+    # id and distance are always fetched: they form the keyset sort key.
+    # The MMR stage also needs the source of every candidate.
+    key_columns = ("id", "distance", "source") if args.mmr else ("id", "distance")
+    sql_columns = columns + [name for name in key_columns if name not in columns]
+
+    # Fail before the (paid) OpenAI request if a needed package is missing
+    check_installed("psycopg2", "psycopg2-binary", "Database access")
+    if args.mmr:
+        check_installed("numpy", "numpy", "--mmr")
+
+    if args.query_vector:
+        # A saved vector needs no OpenAI request and keeps page tokens valid
+        query_embedding, input_text = load_query_vector(args.query_vector)
+        input_method = "query-vector"
+        print("=== Querying Similar Texts ===\n")
+        print(f"Input method: {input_method} ({args.query_vector})")
+        print(f"Vector dimensions: {len(query_embedding)}")
+    else:
+        load_env()
+        api_key = get_api_key()
+
+        # Read input text
+        input_text, input_method, _ = read_text_input(args.text, args.text_file, args.pdf_file)
+
+        print("=== Querying Similar Texts ===\n")
+        print(f"Input method: {input_method}")
+        print(f"Query text length: {len(input_text)} characters")
+
+        # Check if text exceeds token limit and truncate if needed
+        estimated_tokens = estimate_tokens(input_text)
+        print(f"Estimated tokens: {estimated_tokens}")
+
+        if args.documents:
+            query_documents(args, out, input_text, input_method, api_key)
+            return
+
+        if estimated_tokens > CHUNK_SIZE:
+            print(f"\n⚠️  Query text exceeds token limit ({estimated_tokens} tokens > {CHUNK_SIZE})")
+            print(f"Using first {CHUNK_SIZE} tokens (~{CHUNK_SIZE * CHARS_PER_TOKEN} characters) for query...")
+            # Truncate to fit within token limit
+            max_chars = CHUNK_SIZE * CHARS_PER_TOKEN
+            input_text = input_text[:max_chars]
+            print(f"Truncated to {len(input_text)} characters\n")
+
+    print(f"Result limit: Top {args.limit} most similar")
+    if args.offset:
+        print(f"Offset: {args.offset}")
+    if after:
+        print(f"Starting after: distance={after[0]}, id={','.join(map(str, after[1]))}")
+    if args.stream:
+        print(f"Streaming: server-side cursor, {args.batch_size} rows per batch")
+    if args.mmr:
+        print(f"MMR rerank: lambda={args.mmr_lambda}, "
+              f"{max(args.mmr_candidates, args.limit)} candidates"
+              + (f", max {args.max_per_source} per source" if args.max_per_source else ""))
     print()
 
-    # Get embedding for query
-    print("Getting embedding from OpenAI...")
-    response = get_embedding_from_openai(input_text, api_key)
-    query_embedding = response['data'][0]['embedding']
-    print("✓ Query embedding received\n")
+    if not args.query_vector:
+        # Preview query text
+        text_preview = input_text[:100] + ("..." if len(input_text) > 100 else "")
+        print("Query text preview:")
+        print(text_preview)
+        print()
+
+        # Get embedding for query
+        print("Getting embedding from OpenAI...")
+        response = get_embedding_from_openai(input_text, api_key)
+        query_embedding = response['data'][0]['embedding']
+        print("✓ Query embedding received\n")
+
+    vector = json.dumps(query_embedding)
+    if after and after[2] != vector_hash(vector):
+        # Embeddings differ slightly between OpenAI requests, and distances
+        # from a different vector would skip or repeat rows at page edges
+        print("Error: The page token was created for a different query vector.")
+        print("Save the first page's vector with --dump-vector FILE and pass --query-vector FILE")
+        sys.exit(1)
 
     # Dump vector to file if requested
     if args.dump_vector:
-        try:
-            vector_data = {
-                "model": MODEL,
-                "dimensions": len(query_embedding),
-                "embedding": query_embedding,
-                "input_text_length": len(input_text),
-                "input_text_preview": input_text[:100]
-            }
-            with open(args.dump_vector, 'w') as f:
-                json.dump(vector_data, f, indent=2)
-            print(f"✓ Vector saved to {args.dump_vector}\n")
-        except Exception as e:
-            print(f"Warning: Could not save vector to file: {e}\n")
+        dump_vector(args.dump_vector, {
+            "model": MODEL,
+            "dimensions": len(query_embedding),
+            "embedding": query_embedding,
+            "input_text_length": len(input_text),
+            "input_text_preview": input_text[:100]
+        })
+
+    sql = build_similarity_query(sql_columns, keyset=after is not None, with_vectors=args.mmr)
+    params = {"vector": vector, "limit": args.limit, "offset": args.offset}
+    if args.mmr:
+        # Oversample candidates for the rerank stage
+        params["limit"] = max(args.mmr_candidates, args.limit)
+    if after:
+        params["after_distance"], params["after_ids"] = after[:2]
+
+    if args.mmr:
+        # Imported before the timed query so the import is not reported as fetch time
+        np = require("numpy", "numpy", "--mmr")
 
     # Query database
     print("Searching database for similar texts...\n")
     conn = connect_db()
     try:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT
-                    id,
-                    LEFT(text, 100) as text_preview,
-                    source,
-                    metadata,
-                    1 - (embedding <=> %s::vector) as cosine_similarity,
-                    embedding <=> %s::vector as cosine_distance,
-                    created_at
-                FROM text_embeddings
-                ORDER BY embedding <=> %s::vector
-                LIMIT %s
-                """,
-                (json.dumps(query_embedding),) * 3 + (RESULT_LIMIT,)
-            )
+        settings = {}
+        # Decided from the rows actually fetched (MMR oversamples candidates)
+        exact = args.exact or after or params["limit"] + args.offset >= EXACT_SCAN_MIN_K
+        if exact:
+            # SET LOCAL equivalent: lasts until the end of this transaction,
+            # which is also the transaction of the (named) query cursor
+            with conn.cursor() as setup_cur:
+                settings = exact_scan_settings(setup_cur)
+                for name, value in settings.items():
+                    setup_cur.execute("SELECT set_config(%s, %s, true)", (name, value))
+
+        if args.stream:
+            # Named cursor = server-side cursor: rows are fetched in batches
+            # of itersize, so client memory does not grow with --limit
+            cur = conn.cursor(name="query_similar_stream")
+            cur.itersize = args.batch_size
+        else:
+            cur = conn.cursor()
 
+        with cur:
             # Dump query to file if requested
             if args.dump_query:
-                try:
-                    # Prepare SQL template
-                    query_template = """SELECT
-    id,
-    LEFT(text, 100) as text_preview,
-    source,
-    metadata,
-    1 - (embedding <=> $1::vector) as cosine_similarity,
-    embedding <=> $2::vector as cosine_distance,
-    created_at
-FROM text_embeddings
-ORDER BY embedding <=> $3::vector
-LIMIT $4"""
-
-                    # Format vector as PostgreSQL array string
-                    vector_str = json.dumps(query_embedding)
-                    vector_preview = str(query_embedding[:10]) + " ..."
-
-                    # Write file (overwrite mode 'w')
-                    with open(args.dump_query, 'w') as f:
-                        # Header
-                        f.write("-- Query-Similar SQL Dump\n")
-                        f.write(f"-- Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                        f.write(f"-- Input method: {input_method}\n")
-                        f.write(f"-- Vector dimensions: {len(query_embedding)}\n")
-                        f.write(f"-- Result limit: {RESULT_LIMIT}\n\n")
-
-                        # Section 1: Template with parameters
-                        f.write("-- " + "=" * 60 + "\n")
-                        f.write("-- SECTION 1: SQL Template (with parameter placeholders)\n")
-                        f.write("-- " + "=" * 60 + "\n\n")
-                        f.write(query_template + ";\n\n")
-                        f.write("-- Parameters:\n")
-                        f.write(f"-- $1, $2, $3: Query embedding vector ({len(query_embedding)} dimensions)\n")
-                        f.write(f"-- First 10 dimensions: {vector_preview}\n")
-                        f.write(f"-- $4: Result limit = {RESULT_LIMIT}\n\n")
-
-                        # Section 2: Executable SQL
-                        f.write("-- " + "=" * 60 + "\n")
-                        f.write("-- SECTION 2: Executable SQL (ready to run in PostgreSQL)\n")
-                        f.write("-- " + "=" * 60 + "\n\n")
-
-                        # Replace placeholders with actual values
-                        executable_query = query_template.replace("$1", f"'{vector_str}'")
-                        executable_query = executable_query.replace("$2", f"'{vector_str}'")
-                        executable_query = executable_query.replace("$3", f"'{vector_str}'")
-                        executable_query = executable_query.replace("$4", str(RESULT_LIMIT))
-
-                        f.write(executable_query + ";\n\n")
-                        f.write(f"-- Note: Full vector embedded above ({len(query_embedding)} dimensions)\n")
-
-                    print(f"✓ Query saved to {args.dump_query}\n")
-                except Exception as e:
-                    print(f"Warning: Could not save query to file: {e}\n")
-
-            results = cur.fetchall()
-
-            if not results:
+                dump_query(args.dump_query, cur, sql, params, input_method, settings)
+
+            start = time.perf_counter()
+            cur.execute(sql, params)
+            rows = cur
+            if args.mmr:
+                rows = cur.fetchall()
+                fetched = time.perf_counter()
+                vectors = vectors_from_binary([row[-1] for row in rows])
+                distance_index = sql_columns.index("distance")
+                source_index = sql_columns.index("source")
+                relevance = 1 - np.array([row[distance_index] for row in rows], dtype=np.float32)
+                sources = [row[source_index] for row in rows]
+                order = mmr_rerank(vectors, relevance, sources, args.limit,
+                                   args.mmr_lambda, args.max_per_source)
+                rows = [rows[i] for i in order]
+                done = time.perf_counter()
+                print(f"✓ MMR reranked {len(vectors)} candidates: query + fetch "
+                      f"{(fetched - start) * 1000:.1f} ms, rerank {(done - fetched) * 1000:.1f} ms\n")
+
+            sys.stdout.flush()
+            count, last_distance, last_ids = write_results(rows, sql_columns, columns, args.format,
+                                                           out, flush_every=args.batch_size)
+
+        if count == 0:
+            if args.offset or after:
+                print("No more results.")
+            else:
                 print("No results found in database.")
                 print("Add some embeddings first using: store-embeddings")
-                return
+            return
 
-            print(f"=== Search Results (Top {RESULT_LIMIT}) ===\n")
-            print(f"{'ID':<5} {'Text Preview':<50} {'Source':<20} {'Similarity':<12} {'Distance':<12}")
-            print("-" * 110)
-
-            for row in results:
-                id_, text_preview, source, metadata, similarity, distance, created_at = row
-                # Truncate text preview if too long
-                text_preview = (text_preview[:47] + "...") if len(text_preview) > 50 else text_preview
-                source = (source[:17] + "...") if len(source) > 20 else source
-
-                print(f"{id_:<5} {text_preview:<50} {source:<20} {similarity:>11.4f} {distance:>11.4f}")
-
-            print()
+        print()
+        if args.format == "table":
             print("Similarity score interpretation:")
             print("  1.0 = Identical")
             print("  0.9-0.99 = Very similar")
             print("  0.8-0.89 = Similar")
             print("  0.7-0.79 = Somewhat similar")
             print("  <0.7 = Less similar")
+            print()
+        else:
+            print(f"✓ {count} result(s) written")
+
+        paging = args.offset or args.stream or args.format != "table"
+        if count == args.limit and not args.mmr and not exact:
+            # Approximate (probes = 1) pages cannot be continued consistently;
+            # only mentioned when paging through results, not for a plain top-k
+            if paging:
+                print(f"More results may exist. Use --exact (or -k >= {EXACT_SCAN_MIN_K}) "
+                      "to get a next page token.")
+        elif count == args.limit and not args.mmr:
+            # A full page was returned, so there may be more rows
+            if after and last_distance == after[0]:
+                # The whole page tied with the previous boundary
+                last_ids = after[1] + last_ids
+            print(f"Next page token: {make_page_token(last_distance, last_ids, vector)}")
+            if args.query_vector:
+                print(f"  (continue with: --query-vector {args.query_vector} --after TOKEN)")
+            elif args.dump_vector:
+                print(f"  (continue with: --query-vector {args.dump_vector} --after TOKEN)")
+            else:
+                print("  (continue with --query-vector FILE --after TOKEN; save the vector of")
+                print("   this query with --dump-vector FILE)")
+    finally:
+        conn.close()
+
+
+def query_documents(args: argparse.Namespace, out: TextIO, input_text: str,
+                    input_method: str, api_key: str) -> None:
+    """Run query-similar --documents: rank whole sources for a (long) query text."""
+    chunks = chunk_text(input_text, CHUNK_SIZE)
+    print(f"Query chunks: {len(chunks)}")
+    aggregate = args.aggregate
+    if aggregate == "sum-top":
+        aggregate += f" (m={args.top_m})"
+    print(f"Aggregation per source: {aggregate}")
+    print(f"Nearest chunks per query chunk: {args.per_chunk}")
+    print(f"Result limit: Top {args.limit} documents")
+    if args.offset:
+        print(f"Offset: {args.offset}")
+    print()
+
+    # Embed all chunks in one batched request (split only at OpenAI's limits)
+    print(f"Getting embeddings for {len(chunks)} chunk(s) from OpenAI...")
+    embeddings = get_embeddings_batched(chunks, api_key)
+    print("✓ Query embeddings received\n")
+
+    # Dump vectors to file if requested
+    if args.dump_vector:
+        dump_vector(args.dump_vector, {
+            "model": MODEL,
+            "dimensions": len(embeddings[0]),
+            "chunks": len(embeddings),
+            "embeddings": embeddings,
+            "input_text_length": len(input_text),
+            "input_text_preview": input_text[:100]
+        })
+
+    sql = build_document_query(args.aggregate)
+    params = {
+        "vectors": [json.dumps(embedding) for embedding in embeddings],
+        "per_chunk": args.per_chunk,
+        "limit": args.limit,
+        "offset": args.offset,
+    }
+    if args.aggregate == "sum-top":
+        params["top_m"] = args.top_m
+
+    # Query database
+    print("Searching database for similar documents...\n")
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            # Dump query to file if requested
+            if args.dump_query:
+                dump_query(args.dump_query, cur, sql, params, input_method)
+
+            cur.execute(sql, params)
+            results = cur.fetchall()
+
+        if not results:
+            if args.offset:
+                print("No more results.")
+            else:
+                print("No results found in database.")
+                print("Add some embeddings first using: store-embeddings")
+            return
+
+        if args.format == "table":
+            print(f"=== Document Results (Top {args.limit}) ===\n", file=out)
+            print(f"{'Source':<50} {'Score':>11} {'Best Sim.':>11} {'Chunks':>8}", file=out)
+            print("-" * 83, file=out)
+            for source, score, best_similarity, matched_chunks in results:
+                source = source or ""
+                source = (source[:47] + "...") if len(source) > 50 else source
+                print(f"{source:<50} {score:>11.4f} {best_similarity:>11.4f} {matched_chunks:>8}", file=out)
+            print(file=out)
+        elif args.format == "jsonl":
+            for row in results:
+                out.write(json.dumps(dict(zip(DOCUMENT_COLUMNS, row)), default=str) + "\n")
+        else:
+            writer = csv.writer(out)
+            writer.writerow(DOCUMENT_COLUMNS)
+            writer.writerows(results)
+        out.flush()
+
+        if args.format != "table":
+            print(f"✓ {len(results)} result(s) written")
     finally:
         conn.close()
 
@@ -663,6 +1367,9 @@ Examples:
   # Query similar
   python aiembedingdemo.py query-similar --text "Puppy"
   python aiembedingdemo.py query-similar --text-file ../samples/dog.txt
+  python aiembedingdemo.py query-similar --text "Puppy" -k 10000 --stream --format jsonl
+  python aiembedingdemo.py query-similar --pdf-file paper.pdf --documents --aggregate sum-top
+  python aiembedingdemo.py query-similar --text "Puppy" --mmr --max-per-source 2
         """
     )
 
@@ -711,10 +1418,45 @@ Examples:
     input_group.add_argument("--text", type=str, help="Direct text input")
     input_group.add_argument("--text-file", type=str, help="Path to text file")
     input_group.add_argument("--pdf-file", type=str, help="Path to PDF file")
+    input_group.add_argument("--query-vector", type=str, metavar="FILE",
+                             help="Reuse a query vector saved with --dump-vector (no OpenAI request)")
     parser_query.add_argument("--dump-vector", type=str, metavar="FILE",
                              help="Save query embedding vector to JSON file")
     parser_query.add_argument("--dump-query", type=str, metavar="FILE",
                              help="Save SQL query to file")
+    parser_query.add_argument("-k", "--limit", type=int, default=RESULT_LIMIT,
+                             help=f"Number of results to return (default: {RESULT_LIMIT})")
+    parser_query.add_argument("--offset", type=int, default=0,
+                             help="Skip this many results (default: 0)")
+    parser_query.add_argument("--after", type=str, metavar="TOKEN",
+                             help="Continue after a previous page (next page token)")
+    parser_query.add_argument("--exact", action="store_true",
+                             help=f"Exact index scan (automatic for --after and -k >= {EXACT_SCAN_MIN_K})")
+    parser_query.add_argument("--stream", action="store_true",
+                             help="Fetch results through a server-side cursor in batches")
+    parser_query.add_argument("--batch-size", type=int, default=STREAM_BATCH_SIZE,
+                             help=f"Rows per batch with --stream (default: {STREAM_BATCH_SIZE})")
+    parser_query.add_argument("--format", choices=("table", "jsonl", "csv"), default="table",
+                             help="Output format (default: table)")
+    parser_query.add_argument("--documents", action="store_true",
+                             help="Rank whole sources: chunk the full query text and aggregate per source")
+    parser_query.add_argument("--aggregate", choices=tuple(DOCUMENT_AGGREGATES), default="max",
+                             help="Per-source score with --documents (default: max)")
+    parser_query.add_argument("--top-m", type=int, default=TOP_M,
+                             help=f"Chunks summed per source with --aggregate sum-top (default: {TOP_M})")
+    parser_query.add_argument("--per-chunk", type=int, default=PER_CHUNK_LIMIT,
+                             help=f"Nearest chunks per query chunk with --documents (default: {PER_CHUNK_LIMIT})")
+    parser_query.add_argument("--mmr", action="store_true",
+                             help="Rerank results for diversity (maximal marginal relevance)")
+    parser_query.add_argument("--mmr-lambda", type=float, default=MMR_LAMBDA,
+                             help=f"MMR relevance/diversity trade-off, 1.0 = relevance only (default: {MMR_LAMBDA})")
+    parser_query.add_argument("--mmr-candidates", type=int, default=MMR_CANDIDATES,
+                             help=f"Candidates fetched for MMR reranking (default: {MMR_CANDIDATES})")
+    parser_query.add_argument("--max-per-source", type=int,
+                             help="With --mmr, return at most N results per source")
+    parser_query.add_argument("--columns", type=str,
+                             help=f"Columns for jsonl/csv output (default: {DEFAULT_COLUMNS}; "
+                                  f"available: {', '.join(QUERY_COLUMNS)})")
     parser_query.set_defaults(func=cmd_query_similar)
 
     # Parse and execute
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Import-time budget check for aiembedingdemo.py
+
+Runs CLI invocations under `python -X importtime` and sums the import time
+of every module the CLI loads on top of a bare interpreter. Fails (exit
+code 1) when a run exceeds its budget or tries to import a third-party
+package its scenario forbids.
+
+Import attempts are recorded with a sys.meta_path hook, so a forbidden
+import is caught even when the package is not installed.
+
+Real commands (not just --help) are run with OPENAI_API_KEY set to an
+empty string: they stop at the API key check, before any OpenAI request
+or database connection, after importing what they import up front.
+query-similar --query-vector needs no API key: it imports psycopg2 (and
+numpy with --mmr) and connects to the database (read-only query; an
+unreachable database just ends the run).
+
+Usage:
+    python check_import_time.py
+    python check_import_time.py --budget-ms 40 --repeat 10
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Set, Tuple
+
+SCRIPT = Path(__file__).parent / "aiembedingdemo.py"
+BUDGET_MS = 60.0  # Default import-time budget per CLI invocation
+# Added to the budget of paths that really import these packages (their own
+# import time, which the CLI cannot reduce)
+PACKAGE_IMPORT_MS = {"psycopg2": 40.0, "numpy": 120.0}
+REPEAT = 5  # Runs per scenario (the fastest run is reported)
+
+# Third-party packages the CLI may import (top-level module names)
+HEAVY_MODULES = {"openai", "pydantic", "httpx", "psycopg2", "pypdf", "numpy", "dotenv"}
+OPENAI_MODULES = {"openai", "pydantic", "httpx"}
+
+# CLI invocations to measure ({vector} is replaced with a saved query vector).
+#   allowed:   heavy modules the path may import (anything else is reported)
+#   forbidden: heavy modules the path must never try to import
+#   imports:   heavy packages the path imports (raises its budget by PACKAGE_IMPORT_MS)
+# The openai, psycopg2 and numpy entries of get/store-embeddings and
+# query-similar --text are find_spec lookups: these commands only check that
+# the package is installed before they stop at the empty API key.
+SCENARIOS = [
+    {"argv": ["--help"], "allowed": set(), "forbidden": HEAVY_MODULES},
+    {"argv": ["get-embeddings", "--help"], "allowed": set(), "forbidden": HEAVY_MODULES},
+    {"argv": ["store-embeddings", "--help"], "allowed": set(), "forbidden": HEAVY_MODULES},
+    {"argv": ["query-similar", "--help"], "allowed": set(), "forbidden": HEAVY_MODULES},
+    {"argv": ["get-embeddings", "--text", "Dog"],
+     "allowed": {"openai", "dotenv"}, "forbidden": {"pydantic", "httpx", "psycopg2", "pypdf", "numpy"}},
+    {"argv": ["store-embeddings", "--text", "Dog"],
+     "allowed": {"openai", "psycopg2", "dotenv"}, "forbidden": {"pydantic", "httpx", "pypdf", "numpy"}},
+    {"argv": ["query-similar", "--text", "Puppy"],
+     "allowed": {"psycopg2", "dotenv"}, "forbidden": OPENAI_MODULES | {"pypdf", "numpy"}},
+    {"argv": ["query-similar", "--text", "Puppy", "--mmr"],
+     "allowed": {"psycopg2", "numpy", "dotenv"}, "forbidden": OPENAI_MODULES | {"pypdf"}},
+    # No OpenAI request: these import psycopg2 (and numpy) and connect to the
+    # database, so they cover the imports a real query pays for
+    {"argv": ["query-similar", "--query-vector", "{vector}"],
+     "allowed": {"psycopg2"}, "forbidden": OPENAI_MODULES | {"pypdf", "numpy", "dotenv"},
+     "imports": ["psycopg2"]},
+    {"argv": ["query-similar", "--query-vector", "{vector}", "--mmr"],
+     "allowed": {"psycopg2", "numpy"}, "forbidden": OPENAI_MODULES | {"pypdf", "dotenv"},
+     "imports": ["psycopg2", "numpy"]},
+]
+
+# Runs the CLI in-process with an import hook that logs every import attempt
+TRACER = """
+import runpy
+import sys
+
+class ImportTracer:
+    @staticmethod
+    def find_spec(name, path=None, target=None):
+        sys.stderr.write("import attempt: " + name + "\\n")
+        return None
+
+sys.meta_path.insert(0, ImportTracer)
+if len(sys.argv) > 1:
+    sys.argv = sys.argv[1:]
+    runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def parse_output(stderr: str) -> Tuple[Dict[str, int], Set[str]]:
+    """
+    Parse `-X importtime` output and the tracer's import attempts.
+
+    Args:
+        stderr: Standard error of the interpreter
+
+    Returns:
+        Tuple of (module name -> self import time in microseconds,
+        top-level names of all attempted imports)
+    """
+    modules = {}
+    attempts = set()
+    for line in stderr.splitlines():
+        if line.startswith("import attempt: "):
+            attempts.add(line[len("import attempt: "):].split(".")[0])
+        elif line.startswith("import time:") and "self [us]" not in line:
+            self_us, _, name = line[len("import time:"):].split("|")
+            modules[name.strip()] = int(self_us)
+    return modules, attempts
+
+
+def run_traced(argv: List[str]) -> Tuple[Dict[str, int], Set[str]]:
+    """
+    Run the CLI under `-X importtime` with the import tracer.
+
+    Args:
+        argv: CLI arguments (empty: only start the interpreter and tracer)
+
+    Returns:
+        Tuple of (imported modules with self times, attempted top-level imports)
+    """
+    script = [str(SCRIPT), *argv] if argv else []
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", TRACER, *script],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+        env={**os.environ, "OPENAI_API_KEY": ""}
+    )
+    return parse_output(result.stderr)
+
+
+def measure(argv: List[str], baseline: Dict[str, int], repeat: int) -> Tuple[float, Dict[str, int], Set[str]]:
+    """
+    Measure the CLI's own import time for one invocation.
+
+    Args:
+        argv: CLI arguments
+        baseline: Modules imported by the interpreter and tracer alone
+        repeat: Number of runs
+
+    Returns:
+        Tuple of (fastest total in milliseconds, modules of the fastest run,
+        heavy modules the CLI tried to import)
+    """
+    best_ms, best_modules, heavy = float("inf"), {}, set()
+    for _ in range(repeat):
+        modules, attempts = run_traced(argv)
+        modules = {name: self_us for name, self_us in modules.items() if name not in baseline}
+        heavy |= attempts & HEAVY_MODULES
+        total_ms = sum(modules.values()) / 1000
+        if total_ms < best_ms:
+            best_ms, best_modules = total_ms, modules
+    return best_ms, best_modules, heavy
+
+
+def check_scenario(scenario: Dict[str, Any], baseline: Dict[str, int], vector_file: str,
+                   args: argparse.Namespace) -> bool:
+    """
+    Run one scenario and print its report.
+
+    Args:
+        scenario: Entry from SCENARIOS
+        baseline: Modules imported by the interpreter and tracer alone
+        vector_file: Saved query vector for --query-vector scenarios
+        args: Parsed command-line arguments
+
+    Returns:
+        True if the scenario passed
+    """
+    argv = [vector_file if arg == "{vector}" else arg for arg in scenario["argv"]]
+    total_ms, modules, heavy = measure(argv, baseline, args.repeat)
+    forbidden = sorted(heavy & scenario["forbidden"])
+    unexpected = sorted(heavy - scenario["allowed"] - scenario["forbidden"])
+    budget_ms = args.budget_ms + sum(PACKAGE_IMPORT_MS[name] for name in scenario.get("imports", []))
+    ok = not (forbidden or unexpected or total_ms > budget_ms)
+
+    print(f"{'✓' if ok else '✗'} {' '.join(scenario['argv']):<46} {total_ms:>8.1f} ms"
+          f" / {budget_ms:.0f} ms  ({len(modules)} modules)")
+    print(f"    looked up: {', '.join(sorted(heavy)) or '-'}")
+    for name, self_us in sorted(modules.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"    {self_us / 1000:>8.1f} ms  {name}")
+    if forbidden:
+        print(f"    Forbidden imports: {', '.join(forbidden)}")
+    if unexpected:
+        print(f"    Unexpected imports: {', '.join(unexpected)}")
+    return ok
+
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description="Import-time budget check for aiembedingdemo.py")
+    parser.add_argument("--budget-ms", type=float, default=BUDGET_MS,
+                        help=f"Maximum import time per invocation in ms (default: {BUDGET_MS})")
+    parser.add_argument("--repeat", type=int, default=REPEAT,
+                        help=f"Runs per scenario, fastest is used (default: {REPEAT})")
+    parser.add_argument("--top", type=int, default=5,
+                        help="Show the N slowest modules per scenario (default: 5)")
+    args = parser.parse_args()
+
+    baseline, _ = run_traced([])
+    failed = False
+
+    print(f"=== Import-Time Budget: {args.budget_ms:.1f} ms ===\n")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Query vector in the --dump-vector format
+        vector_file = os.path.join(tmp_dir, "query_vector.json")
+        with open(vector_file, "w", encoding="utf-8") as f:
+            json.dump({"embedding": [0.01] * 1536, "input_text_preview": "import-time check"}, f)
+
+        for scenario in SCENARIOS:
+            failed = not check_scenario(scenario, baseline, vector_file, args) or failed
+
+    print()
+    if failed:
+        print("Import-time budget exceeded or forbidden imports found.")
+        sys.exit(1)
+    print("All scenarios within budget.")
+
+
+if __name__ == "__main__":
+    main()